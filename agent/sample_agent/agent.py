@@ -3,27 +3,44 @@ This is the main entry point for the agent.
 It defines the workflow graph, state, tools, nodes and edges.
 """
 
-from typing_extensions import Literal, TypedDict, Dict, List, Any, Union, Optional
-from langchain_openai import ChatOpenAI
+from typing_extensions import Literal, TypedDict, Dict, List, Any, Tuple, Union, Optional, NotRequired, TYPE_CHECKING
 from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
 from langgraph.graph import StateGraph, END
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.types import Command
 from copilotkit import CopilotKitState
-from langchain_mcp_adapters.client import MultiServerMCPClient
 from langgraph.prebuilt import create_react_agent
 from copilotkit.langgraph import (copilotkit_exit)
+from sample_agent.mcp_client import mcp_client_cache
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import logging
 import os
 
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
 # Define the connection type structures
 class StdioConnection(TypedDict):
     command: str
     args: List[str]
     transport: Literal["stdio"]
+    # Tools whose results only depend on their arguments and can be cached
+    cache_tools: NotRequired[List[str]]
+    # Tools answered with a template, e.g. "{a} + {b} = {result}", instead of
+    # a follow-up LLM call
+    direct_response_tools: NotRequired[Dict[str, str]]
 
 class SSEConnection(TypedDict):
     url: str
     transport: Literal["sse"]
+    cache_tools: NotRequired[List[str]]
+    direct_response_tools: NotRequired[Dict[str, str]]
 
 # Type for MCP configuration
 MCPConfig = Dict[str, Union[StdioConnection, SSEConnection]]
@@ -47,9 +64,109 @@ DEFAULT_MCP_CONFIG: MCPConfig = {
         # Use a relative path that will be resolved based on the current working directory
         "args": [os.path.join(os.path.dirname(__file__), "..", "math_server.py")],
         "transport": "stdio",
+        "cache_tools": ["add", "multiply"],
     },
 }
 
+@lru_cache(maxsize=None)
+def get_model() -> "ChatOpenAI":
+    """
+    Return the chat model shared by all ReAct agents.
+    Reusing one instance keeps its OpenAI client, and with it the pooled
+    connections to the API, alive across turns and MCP configuration changes.
+    """
+    # Imported here so that loading the graph does not pull in the OpenAI SDK
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model="gpt-4o")
+
+def uses_openai_api(model: "ChatOpenAI") -> bool:
+    """
+    Whether the model talks to the OpenAI API itself. OpenAI-compatible
+    endpoints, e.g. set via OPENAI_BASE_URL, may reject OpenAI-only fields
+    such as the prompt cache key.
+    """
+    return model.root_async_client.base_url.host == "api.openai.com"
+
+def get_prompt_cache_key(mcp_tools: List[BaseTool]) -> str:
+    """
+    Return the OpenAI prompt cache key for requests made with these tools.
+    """
+    tool_names = ",".join(tool.name for tool in mcp_tools)
+    return "sample_agent-" + hashlib.sha256(tool_names.encode()).hexdigest()[:16]
+
+# The compiled ReAct agent only depends on the MCP tools. The MCP client cache
+# hands out the same tool list for as long as a configuration stays connected,
+# so agents are kept per tool list, keyed by its id. The list itself is kept
+# alongside so its id cannot be reused while the entry exists.
+MAX_CACHED_REACT_AGENTS = 8
+_react_agent_cache: "OrderedDict[int, Tuple[List[BaseTool], Any]]" = OrderedDict()
+
+def get_react_agent(mcp_tools: List[BaseTool]):
+    """
+    Return the ReAct agent for the given tools, building it on first use.
+    """
+    cached = _react_agent_cache.get(id(mcp_tools))
+    if cached is not None and cached[0] is mcp_tools:
+        _react_agent_cache.move_to_end(id(mcp_tools))
+        return cached[1]
+
+    react_agent = build_react_agent(mcp_tools)
+    _react_agent_cache[id(mcp_tools)] = (mcp_tools, react_agent)
+    if len(_react_agent_cache) > MAX_CACHED_REACT_AGENTS:
+        _react_agent_cache.popitem(last=False)
+    return react_agent
+
+def build_react_agent(mcp_tools: List[BaseTool]):
+    """
+    Build a ReAct agent for the given tools.
+    """
+    model = get_model()
+    if mcp_tools and uses_openai_api(model):
+        # Requests with the same tools share a prompt prefix, so route them
+        # to the same prompt cache
+        model = model.bind_tools(
+            mcp_tools,
+            extra_body={"prompt_cache_key": get_prompt_cache_key(mcp_tools)},
+        )
+    return create_react_agent(model, mcp_tools)
+
+# How often the react agent is run again after a tool that responds directly
+# failed. After that it runs once more without direct responses.
+MAX_DIRECT_RESPONSE_RETRIES = 2
+
+def without_direct_responses(mcp_tools: List[BaseTool]) -> List[BaseTool]:
+    """
+    Return the tools with direct responses turned off, so that the LLM
+    phrases every answer.
+    """
+    return [
+        tool.model_copy(update={"return_direct": False}) if tool.return_direct else tool
+        for tool in mcp_tools
+    ]
+
+def trailing_tool_messages(messages: List[BaseMessage]) -> List[ToolMessage]:
+    """
+    Return the tool messages at the end of the conversation.
+    """
+    tool_messages: List[ToolMessage] = []
+    for message in reversed(messages):
+        if not isinstance(message, ToolMessage):
+            break
+        tool_messages.insert(0, message)
+    return tool_messages
+
+def with_direct_response(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    When the ReAct agent stopped right after running tools that respond
+    directly, add their output as the assistant response. Failed tool calls
+    are never turned into a response.
+    """
+    tool_messages = trailing_tool_messages(messages)
+    if not tool_messages or any(message.status == "error" for message in tool_messages):
+        return messages
+    content = "\n".join(str(message.content) for message in tool_messages)
+    return messages + [AIMessage(content=content)]
+
 async def chat_node(state: AgentState, config: RunnableConfig) -> Command[Literal["__end__"]]:
     """
     This is a simplified agent that uses the ReAct agent as a subgraph.
@@ -58,33 +175,43 @@ async def chat_node(state: AgentState, config: RunnableConfig) -> Command[Litera
     # Get MCP configuration from state, or use the default config if not provided
     mcp_config = state.get("mcp_config", DEFAULT_MCP_CONFIG)
 
-    print(f"mcp_config: {mcp_config}, default: {DEFAULT_MCP_CONFIG}")
-    
-    # Set up the MCP client and tools using the configuration from state
-    async with MultiServerMCPClient(mcp_config) as mcp_client:
-        # Get the tools
-        mcp_tools = mcp_client.get_tools()
-        
-        # Create the react agent
-        model = ChatOpenAI(model="gpt-4o")
-        react_agent = create_react_agent(model, mcp_tools)
-        
+    # Formatted lazily, so this costs nothing unless debug logging is enabled
+    logger.debug("mcp_config: %s, default: %s", mcp_config, DEFAULT_MCP_CONFIG)
+
+    # Get the tools, reusing the MCP connections from previous turns with the
+    # same configuration. They stay open while this run uses them.
+    async with mcp_client_cache.tools(mcp_config) as mcp_tools:
+        # Get the react agent for these tools
+        react_agent = get_react_agent(mcp_tools)
+
         # Prepare messages for the react agent
         agent_input = {
             "messages": state["messages"]
         }
-        
+
         # Run the react agent subgraph with our input
         agent_response = await react_agent.ainvoke(agent_input)
-        
-        # Update the state with the new messages
-        updated_messages = state["messages"] + agent_response.get("messages", []) 
-        await copilotkit_exit(config)
-        # End the graph with the updated messages
-        return Command(
-            goto=END,
-            update={"messages": updated_messages},
-        )
+
+        # The react agent also stops when a tool that responds directly
+        # failed. Run it again so the model sees the error and can retry. If
+        # the tool keeps failing, the last run leaves out direct responses so
+        # that the model explains the error instead of the turn ending on it.
+        for retry in range(MAX_DIRECT_RESPONSE_RETRIES + 1):
+            messages = agent_response.get("messages", [])
+            if not any(m.status == "error" for m in trailing_tool_messages(messages)):
+                break
+            if retry == MAX_DIRECT_RESPONSE_RETRIES:
+                react_agent = build_react_agent(without_direct_responses(mcp_tools))
+            agent_response = await react_agent.ainvoke({"messages": messages})
+
+    # Update the state with the new messages
+    updated_messages = state["messages"] + with_direct_response(agent_response.get("messages", []))
+    await copilotkit_exit(config)
+    # End the graph with the updated messages
+    return Command(
+        goto=END,
+        update={"messages": updated_messages},
+    )
 
 # Define the workflow graph with only a chat node
 workflow = StateGraph(AgentState)
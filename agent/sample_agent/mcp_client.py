@@ -0,0 +1,416 @@
+"""
+MCP client handling for the agent.
+Keeps MCP server connections open across chat turns so that every turn does
+not have to spawn stdio servers, redo the MCP handshake and list tools again.
+"""
+
+import anyio
+import asyncio
+import json
+import logging
+import re
+import orjson
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from string import Formatter
+from typing_extensions import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, Union, TYPE_CHECKING, cast
+from langchain_core.tools import BaseTool, StructuredTool
+
+if TYPE_CHECKING:
+    from mcp import ClientSession
+    from langchain_mcp_adapters.client import SSEConnection, StdioConnection
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on cached results per server, oldest entries are dropped first
+MAX_CACHED_TOOL_RESULTS = 1024
+
+# Number of MCP configurations kept connected while no run uses them
+MAX_IDLE_CONFIGS = 4
+
+# Seconds a server gets to start and complete the MCP handshake
+CONNECT_TIMEOUT_SECONDS = 30
+
+
+class ServerConnection(NamedTuple):
+    """
+    An open connection to a single MCP server.
+    """
+    task: asyncio.Task
+    stop: asyncio.Event
+    tools: List[BaseTool]
+
+
+class ConfigConnections:
+    """
+    The server connections of one MCP configuration and the number of runs
+    currently using them.
+    """
+
+    def __init__(self, connect: "asyncio.Task[Tuple[List[ServerConnection], List[BaseTool]]]") -> None:
+        self.connect = connect
+        self.users = 0
+
+    def is_alive(self) -> bool:
+        """
+        Whether the servers are still connecting or all of them are connected.
+        """
+        if not self.connect.done():
+            return True
+        if self.connect.cancelled() or self.connect.exception() is not None:
+            return False
+        servers, _ = self.connect.result()
+        return all(not server.task.done() for server in servers)
+
+    async def close(self) -> None:
+        """
+        Close the connections, or stop connecting if that is still going on.
+        """
+        self.connect.cancel()
+        await asyncio.gather(self.connect, return_exceptions=True)
+        if self.connect.cancelled() or self.connect.exception() is not None:
+            return
+        servers, _ = self.connect.result()
+        await asyncio.gather(*(_close_server(s) for s in servers))
+
+
+class MCPClientCache:
+    """
+    Holds the MCP server connections open for the lifetime of the process.
+
+    The connections are keyed by the MCP configuration they were created
+    from, and every configuration gets its own connections. A run keeps the
+    connections of its configuration open while it uses them, so runs with
+    different configurations do not disturb each other. Up to
+    MAX_IDLE_CONFIGS configurations that no run uses stay connected, the
+    least recently used ones beyond that are closed. Connections whose server
+    went away are replaced on the next use, as are configurations whose
+    servers did not connect within CONNECT_TIMEOUT_SECONDS.
+
+    The MCP transports must be closed from the same task that opened them, so
+    every server gets a dedicated background task instead of living in the
+    task of the graph run that happened to create it. This also lets the
+    servers connect concurrently.
+
+    A connection can list tools under `cache_tools` whose results only depend
+    on their arguments. Results of those tools are cached per server until the
+    connection is closed, so repeated calls skip the MCP round trip.
+
+    A connection can also map tools under `direct_response_tools` to a
+    response template. The agent answers with the filled in template right
+    after such a tool ran, instead of asking the LLM to phrase the result.
+    """
+
+    def __init__(self) -> None:
+        self._configs: "OrderedDict[bytes, ConfigConnections]" = OrderedDict()
+
+    @asynccontextmanager
+    async def tools(self, mcp_config: Optional[Dict[str, Any]]) -> AsyncIterator[List[BaseTool]]:
+        """
+        Provide the tools for the given MCP configuration, connecting to the
+        MCP servers only if they are not connected already. The connections
+        stay open at least until the block exits.
+        """
+        config_key = _json_key(mcp_config or {})
+
+        # Nothing is awaited until the entry is registered and in use, so
+        # concurrent runs with the same configuration share one connect
+        entry = self._configs.get(config_key)
+        replaced = None
+        if entry is not None and not entry.is_alive():
+            replaced = self._configs.pop(config_key)
+            entry = None
+        if entry is None:
+            entry = ConfigConnections(asyncio.create_task(self._connect(mcp_config)))
+            self._configs[config_key] = entry
+        self._configs.move_to_end(config_key)
+        entry.users += 1
+
+        try:
+            if replaced is not None and replaced.users == 0:
+                await replaced.close()
+            # Shielded so that a cancelled run does not abort a connect that
+            # other runs may be waiting for
+            _, tools = await asyncio.shield(entry.connect)
+            yield tools
+        finally:
+            entry.users -= 1
+            if entry.users == 0 and self._configs.get(config_key) is not entry:
+                # Replaced while this run was still using it
+                await entry.close()
+            await self._close_idle()
+
+    async def close(self) -> None:
+        """
+        Close all MCP server connections.
+        """
+        entries = list(self._configs.values())
+        self._configs.clear()
+        await asyncio.gather(*(entry.close() for entry in entries))
+
+    async def _close_idle(self) -> None:
+        """
+        Close unused connections of servers that went away, and the least
+        recently used ones beyond MAX_IDLE_CONFIGS.
+        """
+        idle = [key for key, entry in self._configs.items() if entry.users == 0]
+        alive = [key for key in idle if self._configs[key].is_alive()]
+        to_close = [key for key in idle if key not in alive]
+        to_close += alive[:max(0, len(alive) - MAX_IDLE_CONFIGS)]
+        entries = [self._configs.pop(key) for key in to_close]
+        await asyncio.gather(*(entry.close() for entry in entries))
+
+    async def _connect(self, mcp_config: Optional[Dict[str, Any]]) -> Tuple[List[ServerConnection], List[BaseTool]]:
+        """
+        Connect to all servers of a configuration and collect their tools.
+        """
+        # Connect to all servers at once, startup takes as long as the
+        # slowest server instead of the sum of all of them
+        results = await asyncio.gather(
+            *(
+                self._open_server(server_name, connection)
+                for server_name, connection in (mcp_config or {}).items()
+            ),
+            return_exceptions=True,
+        )
+        servers = [r for r in results if isinstance(r, ServerConnection)]
+        errors = [r for r in results if not isinstance(r, ServerConnection)]
+        if errors:
+            await asyncio.gather(*(_close_server(s) for s in servers))
+            raise errors[0]
+
+        # Keep the tools in a stable order, they are part of the prompt
+        # prefix that the LLM provider can cache
+        tools = sorted(
+            (tool for server in servers for tool in server.tools),
+            key=lambda tool: tool.name,
+        )
+        return servers, tools
+
+    async def _open_server(self, server_name: str, connection: Dict[str, Any]) -> ServerConnection:
+        """
+        Start the background task for a single server and wait for its tools.
+        """
+        connection = dict(connection)
+        cache_tools = set(connection.pop("cache_tools", None) or [])
+        direct_response_tools = connection.pop("direct_response_tools", None) or {}
+
+        ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
+        cancel_scope = anyio.CancelScope()
+        task = asyncio.create_task(self._run_server(server_name, connection, ready, stop, cancel_scope))
+        try:
+            # Bounded, so that a hung handshake fails the configuration and the
+            # next run connects again instead of waiting on it forever
+            done, _ = await asyncio.wait([ready], timeout=CONNECT_TIMEOUT_SECONDS)
+            if not done:
+                raise TimeoutError(
+                    f"MCP server {server_name} did not connect within {CONNECT_TIMEOUT_SECONDS} seconds"
+                )
+            tools = ready.result()
+
+            tool_results: Dict[Tuple[str, str, bytes], Any] = {}
+            wrapped_tools: List[BaseTool] = []
+            for tool in tools:
+                if isinstance(tool, StructuredTool):
+                    if tool.response_format == "content_and_artifact":
+                        tool = _join_text_content(tool)
+                    if tool.name in cache_tools:
+                        tool = _cache_tool_results(server_name, tool, tool_results)
+                    if tool.name in direct_response_tools:
+                        tool = _respond_directly(tool, direct_response_tools[tool.name])
+                wrapped_tools.append(tool)
+        except BaseException:
+            # The task only checks the stop event once connected, a
+            # handshake that never completes has to be cancelled. This goes
+            # through an anyio cancel scope, a plain task cancellation is
+            # used up before the transport kills a server that does not exit.
+            # Cancelling this coroutine while it waits also cancels `ready`.
+            if ready.done() and not ready.cancelled():
+                stop.set()
+            else:
+                cancel_scope.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise
+        return ServerConnection(task=task, stop=stop, tools=wrapped_tools)
+
+    @staticmethod
+    async def _run_server(
+        server_name: str,
+        connection: Dict[str, Any],
+        ready: asyncio.Future,
+        stop: asyncio.Event,
+        cancel_scope: anyio.CancelScope,
+    ) -> None:
+        """
+        Open the connection, hand its tools to the waiting caller and keep it
+        open until asked to stop or until the server goes away. Finishing the
+        task in the latter case is what makes the cache reconnect.
+        """
+        # Imported here so that loading the graph does not pull in the MCP SDK
+        # before the first server is needed
+        from langchain_mcp_adapters.client import MultiServerMCPClient
+
+        with cancel_scope:
+            try:
+                # The connection comes from the frontend config, the adapter
+                # validates its transport and fields when connecting
+                typed_connection = cast(Union["StdioConnection", "SSEConnection"], connection)
+                client = MultiServerMCPClient({server_name: typed_connection})
+                # The client only unwinds a failed connect on Exception, entering
+                # its exit stack as well closes the transport when the connect
+                # is cancelled
+                async with client.exit_stack, client:
+                    ready.set_result(client.get_tools())
+                    await _wait_until_stopped(server_name, client.sessions[server_name], stop)
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(e)
+                else:
+                    logger.warning("Error closing MCP server %s: %s", server_name, e)
+
+
+def _json_key(value: Any) -> bytes:
+    """
+    Serialize a value into a cache key that does not depend on dict order.
+    orjson is used when it can, it rejects e.g. integers beyond 64 bits,
+    which json handles.
+    """
+    try:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        return json.dumps(value, sort_keys=True).encode()
+
+
+async def _close_server(server: ServerConnection) -> None:
+    server.stop.set()
+    await asyncio.gather(server.task, return_exceptions=True)
+
+
+async def _wait_until_stopped(server_name: str, session: "ClientSession", stop: asyncio.Event) -> None:
+    """
+    Wait until asked to stop or until the server closed the connection, e.g.
+    because its process died. The session's incoming messages stream ends
+    when the transport hits EOF, so it is read here only to notice that.
+    """
+    async def read_until_closed() -> None:
+        async for message in session.incoming_messages:
+            if isinstance(message, Exception):
+                logger.warning("Error from MCP server %s: %s", server_name, message)
+
+    closed = asyncio.create_task(read_until_closed())
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({closed, stopped}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        closed.cancel()
+        stopped.cancel()
+        await asyncio.gather(closed, stopped, return_exceptions=True)
+    if not stop.is_set():
+        logger.warning("MCP server %s closed the connection", server_name)
+
+
+def _tool_coroutine(tool: StructuredTool) -> Callable[..., Awaitable[Any]]:
+    """
+    Return the coroutine that runs an MCP tool. The adapter builds every MCP
+    tool from a coroutine, so it is never missing.
+    """
+    assert tool.coroutine is not None, f"MCP tool {tool.name} has no coroutine"
+    return tool.coroutine
+
+
+def _join_text_content(tool: StructuredTool) -> StructuredTool:
+    """
+    Wrap an MCP tool so that a result with several text parts reaches the LLM
+    as one string instead of a list of content blocks.
+    """
+    call_tool = _tool_coroutine(tool)
+
+    async def call_tool_with_text(**arguments: Any) -> Any:
+        content, artifact = await call_tool(**arguments)
+        if isinstance(content, list):
+            content = "\n".join(content)
+        return content, artifact
+
+    return _with_coroutine(tool, call_tool_with_text)
+
+
+def _cache_tool_results(server_name: str, tool: StructuredTool, tool_results: Dict[Tuple[str, str, bytes], Any]) -> StructuredTool:
+    """
+    Wrap an MCP tool so that its results are cached by its arguments.
+    Failed calls raise and are therefore never cached, neither are calls
+    whose arguments cannot be turned into a key.
+    """
+    call_tool = _tool_coroutine(tool)
+
+    async def cached_call_tool(**arguments: Any) -> Any:
+        try:
+            key = (server_name, tool.name, _json_key(arguments))
+        except (TypeError, ValueError):
+            return await call_tool(**arguments)
+        if key in tool_results:
+            return tool_results[key]
+        result = await call_tool(**arguments)
+        if len(tool_results) >= MAX_CACHED_TOOL_RESULTS:
+            del tool_results[next(iter(tool_results))]
+        tool_results[key] = result
+        return result
+
+    return _with_coroutine(tool, cached_call_tool)
+
+
+def _respond_directly(tool: StructuredTool, template: str) -> StructuredTool:
+    """
+    Wrap an MCP tool so that the agent ends its turn right after the tool ran.
+    The tool output becomes the template, formatted with the tool arguments
+    and `result`. Arguments the model left out are formatted as their
+    default, or None if they have none.
+
+    Raises ValueError if the template uses a field that is neither a tool
+    argument nor `result`, or if the tool has an argument named `result`.
+    """
+    defaults = {name: schema.get("default") for name, schema in tool.args.items()}
+    argument_names = set(defaults)
+    if "result" in argument_names:
+        raise ValueError(
+            f"Tool {tool.name} has an argument named 'result', "
+            "which its response template cannot tell apart from the tool result"
+        )
+    for _, field_name, _, _ in Formatter().parse(template):
+        if field_name is None:
+            continue
+        name = re.split(r"[.\[]", field_name, maxsplit=1)[0]
+        if name != "result" and name not in argument_names:
+            raise ValueError(
+                f"Response template for tool {tool.name} uses unknown field {field_name!r}"
+            )
+
+    call_tool = _tool_coroutine(tool)
+
+    async def call_tool_with_template(**arguments: Any) -> Any:
+        result = await call_tool(**arguments)
+        values = {**defaults, **arguments}
+        if tool.response_format == "content_and_artifact":
+            content, artifact = result
+            return template.format(**values, result=content), artifact
+        return template.format(**values, result=result)
+
+    return _with_coroutine(tool, call_tool_with_template, return_direct=True)
+
+
+def _with_coroutine(tool: StructuredTool, coroutine: Any, return_direct: bool = False) -> StructuredTool:
+    """
+    Return a copy of the tool that runs the given coroutine instead.
+    """
+    return StructuredTool(
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        coroutine=coroutine,
+        response_format=tool.response_format,
+        return_direct=return_direct or tool.return_direct,
+    )
+
+
+# Shared by all runs of the graph in this process
+mcp_client_cache = MCPClientCache()
@@ -0,0 +1,83 @@
+"""
+Tests for the MCP connection cache, run with `python -m unittest` from the
+agent folder.
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+from sample_agent import mcp_client
+from sample_agent.mcp_client import MCPClientCache
+
+MATH_SERVER = {
+    "command": sys.executable,
+    "args": [os.path.join(os.path.dirname(__file__), "..", "math_server.py")],
+    "transport": "stdio",
+}
+
+# Starts like a stdio server but never answers the MCP handshake
+HUNG_SERVER = {
+    "command": sys.executable,
+    "args": ["-c", "import time; time.sleep(60)"],
+    "transport": "stdio",
+}
+
+# Upper bound for anything that must not hang
+DEADLINE_SECONDS = 20
+
+
+class MCPClientCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self) -> None:
+        self.cache = MCPClientCache()
+
+    async def asyncTearDown(self) -> None:
+        await asyncio.wait_for(self.cache.close(), DEADLINE_SECONDS)
+
+    async def use(self, mcp_config):
+        async with self.cache.tools(mcp_config) as tools:
+            return sorted(tool.name for tool in tools)
+
+    async def test_reuses_connection(self) -> None:
+        config = {"math": MATH_SERVER}
+        async with self.cache.tools(config) as first:
+            pass
+        async with self.cache.tools(config) as second:
+            self.assertIs(first, second)
+            add = next(tool for tool in second if tool.name == "add")
+            self.assertEqual(await add.ainvoke({"a": 1, "b": 2}), "3")
+
+    async def test_hung_connect_times_out_and_reconnects(self) -> None:
+        config = {"hung": HUNG_SERVER}
+        with mock.patch.object(mcp_client, "CONNECT_TIMEOUT_SECONDS", 1):
+            for _ in range(2):
+                with self.assertRaises(TimeoutError):
+                    await asyncio.wait_for(self.use(config), DEADLINE_SECONDS)
+        self.assertEqual(len(self.cache._configs), 0)
+
+    async def test_close_while_connecting(self) -> None:
+        run = asyncio.create_task(self.use({"hung": HUNG_SERVER}))
+        await asyncio.sleep(1)
+        await asyncio.wait_for(self.cache.close(), DEADLINE_SECONDS)
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(run, DEADLINE_SECONDS)
+
+    async def test_hung_config_does_not_block_others(self) -> None:
+        # A cancelled run leaves its connect running for other runs
+        hung_run = asyncio.create_task(self.use({"hung": HUNG_SERVER}))
+        await asyncio.sleep(1)
+        hung_run.cancel()
+        await asyncio.gather(hung_run, return_exceptions=True)
+
+        # Enough other configurations to make the cache evict the hung one
+        for i in range(mcp_client.MAX_IDLE_CONFIGS + 1):
+            tools = await asyncio.wait_for(self.use({f"math{i}": MATH_SERVER}), DEADLINE_SECONDS)
+            self.assertEqual(tools, ["add", "multiply"])
+        self.assertEqual(len(self.cache._configs), mcp_client.MAX_IDLE_CONFIGS)
+
+
+if __name__ == "__main__":
+    unittest.main()